@@ -5,12 +5,27 @@ Description:
   Clean up a latex .bib record on the clipboard or retrieved from the doi.
 
 Usage:
-  cleanbib   [--doi=<doi>] 
+  cleanbib   [--doi=<doi>] [--db=<database>]
+  cleanbib --check <bibfile> [--max-errors=<n>] [--jobs=<n>]
+  cleanbib --export --db=<database> [--key=<key>...] [--doi=<doi>]
+           [--author=<author>] [--year=<year>] [--journal=<journal>]
+           [--title=<words>] [--output=<bibfile>]
   cleanbib -h | --help
 
 Options:
   -h --help                Show this screen.
   -d <doi> --doi=<doi>     A valid doi.
+  --db=<database>          A SQLite library to store cleaned entries in.
+  -e --export              Export entries from the library to .bib.
+  -k <key> --key=<key>     Select entries by cite key.
+  --author=<author>        Select entries by first author's last name.
+  --year=<year>            Select entries by year.
+  --journal=<journal>      Select entries by abbreviated journal.
+  --title=<words>          Select entries by a full text search of the title.
+  -o <bibfile> --output=<bibfile>  Write exported entries to a file.
+  -c --check               Lint a .bib file without rewriting it.
+  --max-errors=<n>         Stop checking after n violations [default: 100].
+  -j <n> --jobs=<n>        Number of worker processes (default: all cores).
 """
 
 # Adrian Del Maestro
@@ -28,9 +43,18 @@ from docopt import docopt
 import pyperclip
 import requests
 import re
+import sys
+import sqlite3
+from urllib.request import pathname2url
+from multiprocessing import Pool
 from string import ascii_letters
 from random import choice
 
+# the fields we strip from every cleaned entry
+remove_keys = ['month', 'keyword', 'language', 'read', 'rating',
+               'date-added', 'date-modified', 'abstract', 'local-url',
+               'file', 'uri', 'ISSN', 'issn','keywords', 'numpages']
+
 # -----------------------------------------------------------------------------
 journal_abbreviations = {'AIAA Journal': 'AIAA J.',
  'AIChE Journal': 'AIChE J.',
@@ -646,15 +670,496 @@ def format(record):
 
     return record
 
+# -------------------------------------------------------------------------------
+def check(record):
+    """Test a record against the rules applied by format without modifying it
+       or touching the network.
+
+    :param record: a record
+    :returns: -- a list of (cite key, message) violations
+    """
+
+    key = record.get('ID', '?')
+    errors = []
+
+    # journal names should already be abbreviated
+    if record.get('journal') in journal_abbreviations:
+        errors.append((key, 'journal "%s" should be "%s"' % (record['journal'],
+                       journal_abbreviations[record['journal']])))
+
+    # author names should survive another pass through clean_names unchanged
+    # (up to how the field is wrapped)
+    if 'author' in record:
+        names = {'author': record['author'].replace('~',' ')}
+        try:
+            names = bibtexparser.customization.author(names)['author']
+            if clean_names(names) != ' '.join(record['author'].split()):
+                errors.append((key, 'author names are not normalized'))
+        except bibtexparser.customization.InvalidName:
+            errors.append((key, 'author names cannot be parsed'))
+
+    # none of the stripped fields should be present
+    for rkey in remove_keys:
+        if rkey in record:
+            errors.append((key, 'field "%s" should be removed' % rkey))
+
+    # only a single page number is allowed
+    if 'pages' in record and not re.fullmatch(r'\d+', record['pages']):
+        errors.append((key, 'pages "%s" is not a single page number'
+                       % record['pages']))
+
+    return errors
+
+# -------------------------------------------------------------------------------
+brace_delimiters = {close: re.compile('[{}%s]' % re.escape(close))
+                    for close in '})"'}
+
+def match_brace(text, pos, close='}'):
+    """Return the index of the close delimiter matching the opening one at pos,
+       skipping over any nested braces."""
+
+    depth = 0
+    for delimiter in brace_delimiters[close].finditer(text, pos+1):
+        if delimiter.group() == '{':
+            depth += 1
+        elif delimiter.group() == '}' and depth:
+            depth -= 1
+        elif delimiter.group() == close and not depth:
+            return delimiter.start()
+    raise ValueError('unbalanced braces')
+
+# -------------------------------------------------------------------------------
+entry_head = re.compile(r'@\s*(\w+)\s*([{(])\s*')
+entry_key = re.compile(r'([^,\s]*)\s*,?')
+field_name = re.compile(r'[\s,]*([^\s=,{}()"#]+)\s*=\s*')
+bare_value = re.compile(r'[^\s,#{}()"]+')
+entry_start = re.compile(r'^[ \t]*@\s*\w+\s*[{(]', re.MULTILINE)
+
+def find_entries(text):
+    """Return the (start, end) positions of the entries in bibtex text.
+
+    Entries are delimited by matching their braces, so an @ inside a field
+    value never starts a new entry.  An unterminated entry runs up to the
+    next line that starts an entry.
+
+    :param text: bibtex text
+    :returns: -- a list of (start, end) positions
+    """
+
+    spans = []
+    pos = text.find('@')
+    while pos != -1:
+        head = entry_head.match(text, pos)
+        if not head:
+            pos = text.find('@', pos+1)
+            continue
+        close = '}' if head.group(2) == '{' else ')'
+        try:
+            end = match_brace(text, head.start(2), close)+1
+        except ValueError:
+            next_entry = entry_start.search(text, head.end())
+            end = next_entry.start() if next_entry else len(text)
+        spans.append((pos, end))
+        pos = text.find('@', end)
+    return spans
+
+# -------------------------------------------------------------------------------
+def scan_entry(text, pos, strings):
+    """Scan a single bibtex entry starting at the @ at pos.
+
+    This is a lightweight alternative to the bibtexparser parser for when
+    we only need to look at field values: field names are lowercased,
+    @string macros and # concatenation are expanded and no customization
+    is applied.  @string definitions are added to strings.
+
+    :param text: bibtex text
+    :param pos: the position of the @ starting the entry
+    :param strings: a dictionary of @string macros
+    :returns: -- (record or None, the position after the entry)
+    :raises ValueError: -- if the entry is malformed
+    """
+
+    head = entry_head.match(text, pos)
+    if not head:
+        raise ValueError('not an entry')
+    kind = head.group(1).lower()
+    close = '}' if head.group(2) == '{' else ')'
+    pos = head.end()
+
+    if kind in ['comment', 'preamble']:
+        return None, match_brace(text, head.start(2), close)+1
+
+    record = {'ENTRYTYPE': kind}
+    if kind != 'string':
+        key = entry_key.match(text, pos)
+        record['ID'] = key.group(1)
+        pos = key.end()
+
+    try:
+        while True:
+            name = field_name.match(text, pos)
+            if not name:
+                break
+            pos = name.end()
+
+            # a value is a # separated list of {...}, "..." or bare words
+            value = ''
+            while True:
+                if text[pos] == '{':
+                    end = match_brace(text, pos)
+                    value += text[pos+1:end]
+                    pos = end+1
+                elif text[pos] == '"':
+                    end = match_brace(text, pos, '"')
+                    value += text[pos+1:end]
+                    pos = end+1
+                else:
+                    word = bare_value.match(text, pos)
+                    if not word:
+                        raise ValueError('missing value')
+                    value += strings.get(word.group().lower(), word.group())
+                    pos = word.end()
+                while text[pos].isspace():
+                    pos += 1
+                if text[pos] != '#':
+                    break
+                pos += 1
+                while text[pos].isspace():
+                    pos += 1
+
+            record[name.group(1).lower()] = re.sub(r'\n\s*', '\n',
+                                                   value.strip())
+
+        # the entry must end here
+        while text[pos].isspace() or text[pos] == ',':
+            pos += 1
+    except IndexError:
+        raise ValueError('unterminated entry')
+    if text[pos] != close:
+        raise ValueError('unexpected text in entry')
+
+    if kind == 'string':
+        strings.update((k.lower(), v) for k,v in record.items()
+                       if k != 'ENTRYTYPE')
+        return None, pos+1
+    return record, pos+1
+
+# -------------------------------------------------------------------------------
+def check_chunk(chunk):
+    """Scan and check a chunk of entries (used by the worker processes).
+
+    :param chunk: a tuple of a list of bibtex entries and a dictionary of
+                  @string macros
+    :returns: -- a list of (cite key, message) violations
+    """
+
+    entries,strings = chunk
+    strings = dict(strings)
+    errors = []
+    for entry in entries:
+        try:
+            record = scan_entry(entry, 0, strings)[0]
+        except ValueError:
+            key = entry_key.match(entry, entry_head.match(entry).end())
+            errors.append((key.group(1) or '?', 'entry could not be parsed'))
+            continue
+        if record:
+            errors += check(record)
+    return errors
+
+# -------------------------------------------------------------------------------
+def check_bibfile(filename, max_errors=100, jobs=None):
+    """Lint a .bib file in parallel, stopping once max_errors violations
+       have been found.
+
+    :param filename: the .bib file to check
+    :param max_errors: the maximum number of violations to report
+    :param jobs: the number of worker processes (None uses all cores)
+    :returns: -- a list of (cite key, message) violations
+    """
+
+    with open(filename) as bibtex_file:
+        text = bibtex_file.read()
+    spans = find_entries(text)
+
+    # @string macros may be used anywhere, so collect them all up front
+    strings = {}
+    for start,end in spans:
+        if entry_head.match(text, start).group(1).lower() == 'string':
+            try:
+                scan_entry(text[start:end], 0, strings)
+            except ValueError:
+                pass
+
+    # hand the entries out in chunks which are scanned and checked by the
+    # workers
+    chunk_size = 500
+    chunks = (([text[start:end] for start,end in spans[i:i+chunk_size]],
+               strings) for i in range(0, len(spans), chunk_size))
+
+    errors = []
+    with Pool(jobs) as pool:
+        for chunk_errors in pool.imap(check_chunk, chunks):
+            errors += chunk_errors
+            if len(errors) >= max_errors:
+                pool.terminate()
+                break
+
+    return errors[:max_errors]
+
+# -------------------------------------------------------------------------------
+def open_library(filename, create=True):
+    """Open (creating if needed) a SQLite library of cleaned entries.
+
+    Entries are indexed by cite key, doi, first author, year and journal and
+    their titles are kept in a full text search index.  This needs SQLite
+    3.24 or later built with FTS5.
+
+    :param filename: the SQLite database file
+    :param create: create the library if it doesn't exist, otherwise it
+                   must be an existing library
+    :returns: -- a sqlite3 connection
+    """
+
+    if sqlite3.sqlite_version_info < (3, 24, 0):
+        raise RuntimeError('the library needs SQLite 3.24 or later, found %s'
+                           % sqlite3.sqlite_version)
+
+    if create:
+        conn = sqlite3.connect(filename)
+    else:
+        conn = sqlite3.connect('file:%s?mode=rw' % pathname2url(filename),
+                               uri=True)
+
+    if not conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')"
+                        ).fetchone()[0]:
+        conn.close()
+        raise RuntimeError('the library needs SQLite built with FTS5')
+
+    # never add our schema to some other existing database
+    if not create:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                            "AND name = 'entries'").fetchone():
+            conn.close()
+            raise RuntimeError('not a cleanbib library')
+        return conn
+
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            key TEXT UNIQUE NOT NULL,
+            doi TEXT COLLATE NOCASE,
+            first_author TEXT COLLATE NOCASE,
+            year TEXT,
+            journal TEXT COLLATE NOCASE,
+            title TEXT,
+            bibtex TEXT NOT NULL);
+        CREATE UNIQUE INDEX IF NOT EXISTS entries_doi ON entries(doi);
+        CREATE INDEX IF NOT EXISTS entries_first_author ON entries(first_author);
+        CREATE INDEX IF NOT EXISTS entries_year ON entries(year);
+        CREATE INDEX IF NOT EXISTS entries_journal ON entries(journal);
+
+        -- keep the title search index in sync with the entries table
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+            title, content='entries', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts(rowid, title) VALUES (new.id, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, title)
+                VALUES ('delete', old.id, old.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, title)
+                VALUES ('delete', old.id, old.title);
+            INSERT INTO entries_fts(rowid, title) VALUES (new.id, new.title);
+        END;
+    ''')
+
+    return conn
+
+# -------------------------------------------------------------------------------
+def unique_key(conn, key):
+    """Return a cite key that isn't in the library by replacing the random
+       characters at the end of a generated key (or adding some).
+
+    :param conn: a library connection from open_library
+    :param key: a cite key already in the library
+    :returns: -- a new cite key
+    """
+
+    base = key[:-2] if re.search(r':\d+[a-z]{2}$', key) else key
+    num_chars = 2
+    while True:
+        for attempt in range(100):
+            new_key = base + ''.join([choice(ascii_letters[:26])
+                                      for i in range(num_chars)])
+            if not conn.execute('SELECT 1 FROM entries WHERE key = ?',
+                                (new_key,)).fetchone():
+                return new_key
+
+        # we are running out of keys with this many characters
+        num_chars += 1
+
+# -------------------------------------------------------------------------------
+def store_entries(conn, entries):
+    """Add cleaned entries to the library, replacing any with the same cite key
+       or doi.
+
+    An entry with the doi of one already in the library takes over its cite
+    key (so the randomly generated keys don't produce duplicates) and the
+    record is updated to match.  An entry whose cite key is already used by
+    a paper with a different doi is given a new key instead.
+
+    :param conn: a library connection from open_library
+    :param entries: a list of cleaned records
+    """
+
+    # each entry is stored already serialized so exports never need to reparse
+    writer = bibtexparser.bwriter.BibTexWriter()
+    bib_database = bibtexparser.bibdatabase.BibDatabase()
+
+    with conn:
+        for paper in entries:
+
+            # reuse the cite key of the same paper if we have seen it before
+            doi = paper.get('doi') or None
+            if doi:
+                row = conn.execute('SELECT key FROM entries WHERE doi = ?',
+                                   (doi,)).fetchone()
+                if row:
+                    paper['ID'] = row[0]
+
+            # but never overwrite a different paper that shares the cite key
+            row = conn.execute('SELECT doi FROM entries WHERE key = ?',
+                               (paper['ID'],)).fetchone()
+            if row and row[0] and row[0].lower() != (doi or '').lower():
+                paper['ID'] = unique_key(conn, paper['ID'])
+
+            # index names and titles without any latex protecting braces
+            first_author = paper.get('author', '').split(' and ')[0]
+            first_author = first_author.split(',')[0]
+            first_author = first_author.replace('{','').replace('}','').strip()
+            title = paper.get('title', '').replace('{','').replace('}','')
+
+            bib_database.entries = [paper]
+            conn.execute('''
+                INSERT INTO entries (key, doi, first_author, year, journal,
+                                     title, bibtex)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    doi=excluded.doi, first_author=excluded.first_author,
+                    year=excluded.year, journal=excluded.journal,
+                    title=excluded.title, bibtex=excluded.bibtex''',
+                (paper['ID'], doi, first_author,
+                 paper.get('year'), paper.get('journal'), title,
+                 writer.write(bib_database)))
+
+# -------------------------------------------------------------------------------
+def query_library(conn, keys=None, doi=None, author=None, year=None,
+                  journal=None, title=None):
+    """Find the entries in the library matching all of the given selections.
+
+    :param conn: a library connection from open_library
+    :param keys: a list of cite keys
+    :param doi: a doi
+    :param author: the first author's last name
+    :param year: the year
+    :param journal: the abbreviated journal name
+    :param title: words which must all appear in the title
+    :returns: -- an iterator over the bibtex text of the matching entries
+    """
+
+    where = []
+    params = []
+    if keys:
+        where.append('key IN (%s)' % ','.join('?' * len(keys)))
+        params += keys
+    for column,value in [('doi', doi), ('first_author', author),
+                         ('year', year), ('journal', journal)]:
+        if value:
+            where.append('%s = ?' % column)
+            params.append(value)
+    if title:
+        # quote each word so it isn't interpreted as FTS5 query syntax
+        where.append('id IN (SELECT rowid FROM entries_fts '
+                     'WHERE entries_fts MATCH ?)')
+        params.append(' '.join('"' + word.replace('"','""') + '"'
+                               for word in title.split()))
+
+    query = 'SELECT bibtex FROM entries'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY key'
+
+    for (bibtex,) in conn.execute(query, params):
+        yield bibtex
+
+# -------------------------------------------------------------------------------
+def export_entries(bibtex_entries, out):
+    """Stream bibtex entries to an open file."""
+    for bibtex in bibtex_entries:
+        out.write(bibtex)
+        out.write('\n')
+
 # -------------------------------------------------------------------------------
 # Begin main program
 # -------------------------------------------------------------------------------
 
+def positive_int(value, option):
+    """Convert a command line value to a positive integer or exit."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        sys.exit('cleanbib: %s must be a positive integer' % option)
+    return number
+
 def main():
 
     # Get the command line arguments
     args = docopt(__doc__)
 
+    # lint an existing .bib file and report any violations
+    if args['--check']:
+        max_errors = positive_int(args['--max-errors'], '--max-errors')
+        jobs = positive_int(args['--jobs'], '--jobs') if args['--jobs'] else None
+        try:
+            errors = check_bibfile(args['<bibfile>'], max_errors, jobs)
+        except (OSError, UnicodeDecodeError) as e:
+            sys.exit('cleanbib: cannot read %s: %s' % (args['<bibfile>'],
+                     getattr(e, 'strerror', None) or e))
+        for key,message in errors:
+            print('%s: %s' % (key, message))
+        sys.exit(1 if errors else 0)
+
+    # write a selection of entries from the library back out to .bib
+    if args['--export']:
+        conn = None
+        try:
+            conn = open_library(args['--db'], create=False)
+            bibtex_entries = query_library(conn, keys=args['--key'],
+                                           doi=args['--doi'],
+                                           author=args['--author'],
+                                           year=args['--year'],
+                                           journal=args['--journal'],
+                                           title=args['--title'])
+            if args['--output']:
+                with open(args['--output'], 'w') as out:
+                    export_entries(bibtex_entries, out)
+            else:
+                export_entries(bibtex_entries, sys.stdout)
+        except (RuntimeError, sqlite3.Error) as e:
+            sys.exit('cleanbib: cannot read library %s: %s' % (args['--db'], e))
+        except OSError as e:
+            sys.exit('cleanbib: cannot write %s: %s' % (args['--output'],
+                     e.strerror or e))
+        finally:
+            if conn is not None:
+                conn.close()
+        return
+
     if args['--doi']:
         bibtex_entry = bibtex_from_doi(args['--doi'])
     else:
@@ -669,22 +1174,35 @@ def main():
     # create the bibfile object and parse to get the dictionary
     bib_database = bibtexparser.loads(bibtex_entry, parser=parser)
 
-    # prepare a list of keys we want to delete from the entry
-    remove_keys = ['month', 'keyword', 'language', 'read', 'rating',
-                   'date-added', 'date-modified', 'abstract', 'local-url',
-                   'file', 'uri', 'ISSN', 'issn','keywords', 'numpages']
-
     # Strip those keys from the dictionary
     for paper in bib_database.entries:
         for rkey in remove_keys:
             if rkey in paper:
                 del paper[rkey]
 
+    # keep a copy of the cleaned entries in the library, a failure here is
+    # only reported after we have produced the cleaned entries
+    library_error = None
+    if args['--db']:
+        conn = None
+        try:
+            conn = open_library(args['--db'])
+            store_entries(conn, bib_database.entries)
+        except (RuntimeError, sqlite3.Error) as e:
+            library_error = 'cleanbib: cannot write library %s: %s' % (
+                args['--db'], e)
+        finally:
+            if conn is not None:
+                conn.close()
+
     # Copy back to the pasteboard
     pyperclip.copy(bibtexparser.dumps(bib_database))
 
     # output to the terminal
     print(bibtexparser.dumps(bib_database))
 
+    if library_error:
+        sys.exit(library_error)
+
 if __name__ == '__main__':
     main()